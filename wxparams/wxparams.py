@@ -12,7 +12,16 @@ Copyright (c) Yoshiki Kato @ Weather Data Science
 -*- coding: utf-8 -*-
 """
 import numpy as np
-import copy
+import math
+
+try:
+    from numba import njit, prange, vectorize
+except ImportError:
+    njit = None
+
+#--Types of single values for which wind-related functions use math module,
+#  which is faster than numpy for them
+_NUMBER = (float, int)
 
 #--Global parameters
 abs_t = 273.15
@@ -25,6 +34,9 @@ gamma_d = 0.00976
 gamma_s = 0.0065
 kappa = 5.257
 
+#--Scale factor from degree to radian
+_DEG2RAD = math.pi / 180.
+
 
 """
 *----------------------*
@@ -35,20 +47,31 @@ Calculate wind velocity[m/s, kt, etc] and wind direction[degree]
 given U and V components of winds[m/s, kt, etc].
 """
 def UV_to_SpdDir(u,v):
-    wspd = np.sqrt( u**2 + v**2 )
-    wdir = np.rad2deg( np.arctan2(u,v) ) + 180.0
+    wspd = np.sqrt( u*u + v*v )
+    # asanyarray makes a writable array of scalar input, keeping the mask of masked arrays
+    wdir = np.asanyarray( np.rad2deg( np.arctan2(u,v) ) )
+    wdir += 180.0
 
     wdir[ wdir==0 ] = 360.0
     wdir[ wspd==0 ] = 0.0
-    return wspd, wdir
+    return wspd, wdir[()]
 
 """
 Calculate U and V components of winds[m/s, kt, etc]
 given wind velocity[m/s, kt, etc] and wind direction[degree].
 """
 def SpdDir_to_UV(wspd, wdir):
-	u = - wspd * np.sin( np.deg2rad(wdir) )
-	v = - wspd * np.cos( np.deg2rad(wdir) )
+	if type(wspd) in _NUMBER and type(wdir) in _NUMBER:
+		# math module raises ValueError for infinite angle, where numpy returns nan
+		try:
+			rad = math.radians(wdir)
+			return - wspd * math.sin(rad), - wspd * math.cos(rad)
+		except ValueError:
+			return math.nan, math.nan
+
+	rad = np.multiply(wdir, _DEG2RAD)
+	u = - wspd * np.sin(rad)
+	v = - wspd * np.cos(rad)
 	return u, v
 
 """
@@ -57,20 +80,16 @@ like "N, NE, E, SE, S, SW, W, NW", or "8, 1, 2, 3, 4, 5, 6, 7".
 """
 def Deg_to_Dir8(val, dir_zero=None, numeric=False):
     dirname = ['N','NE','E','SE','S','SW','W','NW', dir_zero]
-    deg = copy.deepcopy(val)
-    deg[ deg==0 ] = 720
-
-    deg = deg + 22.5
-    deg[ deg>=360 ] -= 360
-    deg = (deg/45).astype(np.int64)
+    zero = (val == 0)
+    deg = np.divide(val + 22.5, 45).astype(np.int64) % 8
 
     if numeric:
-        deg[ deg==8 ] = 999
-        deg[ deg==0 ] = 8
-        deg[ deg==999 ] = 0
-        return deg
+        # Sector 0 (north) is numbered 8, and calm is numbered 0
+        deg = np.where(deg==0, 8, deg)
+        deg[zero] = 0
+        return deg[()]
     else:
-        return np.frompyfunc(lambda x: dirname[x], 1, 1)(deg)
+        return np.asarray(dirname, dtype=object)[ np.where(zero, 8, deg) ]
 
 """
 Convert 360-degree wind direction into 16 directions of winds,
@@ -79,20 +98,16 @@ or "16, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15".
 """
 def Deg_to_Dir16(val, dir_zero=None, numeric=False):
     dirname = ['N','NNE','NE','ENE','E','ESE','SE','SSE','S','SSW','SW','WSW','W','WNW','NW','NNW',dir_zero]
-    deg = copy.deepcopy(val)
-    deg[ deg==0 ] = 720
-
-    deg = deg + 11.25
-    deg[ deg>=360 ] -= 360
-    deg = (deg/22.5).astype(np.int64)
+    zero = (val == 0)
+    deg = np.divide(val + 11.25, 22.5).astype(np.int64) % 16
 
     if numeric:
-        deg[ deg==16 ] = 999
-        deg[ deg==0 ] = 16
-        deg[ deg==999 ] = 0
-        return deg
+        # Sector 0 (north) is numbered 16, and calm is numbered 0
+        deg = np.where(deg==0, 16, deg)
+        deg[zero] = 0
+        return deg[()]
     else:
-        return np.frompyfunc(lambda x: dirname[x], 1, 1)(deg)
+        return np.asarray(dirname, dtype=object)[ np.where(zero, 16, deg) ]
 
 """
 Calculate cross wind, tail wind, and head wind component of wind
@@ -100,14 +115,44 @@ given wind velocity[m/s, kt, etc], wind direction[degree],
 and runway direction[degree] of a airpot.
 """
 def Cross_Wind(wspd, wdir, rwy):
-    return np.abs( wspd * np.sin( np.deg2rad(wdir - rwy) ) )
+    if type(wspd) in _NUMBER and type(wdir) in _NUMBER and type(rwy) in _NUMBER:
+        try:
+            return abs( wspd * math.sin( math.radians(wdir - rwy) ) )
+        except ValueError:
+            return math.nan
+    return np.abs( wspd * np.sin( (wdir - rwy) * _DEG2RAD ) )
 
 def Tail_Wind(wspd, wdir, rwy):
-    return - wspd * np.cos( np.deg2rad(wdir - rwy) )
+    if type(wspd) in _NUMBER and type(wdir) in _NUMBER and type(rwy) in _NUMBER:
+        try:
+            return - wspd * math.cos( math.radians(wdir - rwy) )
+        except ValueError:
+            return math.nan
+    return - wspd * np.cos( (wdir - rwy) * _DEG2RAD )
 
 def Head_Wind(wspd, wdir, rwy):
     return - Tail_Wind(wspd, wdir, rwy)
 
+"""
+Calculate cross wind, tail wind, and head wind component of wind at once.
+The angle between wind and runway is converted only once,
+so it is faster than calling the three functions above separately.
+"""
+def Runway_Wind(wspd, wdir, rwy):
+    if type(wspd) in _NUMBER and type(wdir) in _NUMBER and type(rwy) in _NUMBER:
+        try:
+            rad = math.radians(wdir - rwy)
+            cross = abs( wspd * math.sin(rad) )
+            tail = - wspd * math.cos(rad)
+            return cross, tail, - tail
+        except ValueError:
+            return math.nan, math.nan, math.nan
+
+    rad = (wdir - rwy) * _DEG2RAD
+    cross = np.abs( wspd * np.sin(rad) )
+    tail = - wspd * np.cos(rad)
+    return cross, tail, - tail
+
 
 """
 *--------------------------*
@@ -119,6 +164,9 @@ given air temperature[C] and relative humidity[%].
 """
 def RH_to_Td(t, rh, formula="Bolton"):
     rh = rh.clip(0.1, None)
+    if _T_TO_WVP[formula] is _wvp_bolton:
+        a = 17.67 * t / (t + 243.5) + np.log(rh / 100)
+        return 243.5 * a / (17.67 - a)
     es = T_to_WVP(t, formula)
     e = es * rh / 100
     return WVP_to_T(e, formula)
@@ -128,6 +176,8 @@ Calculate relative humidity[%]
 given air temperature[C] and dew point temperature[C].
 """
 def Td_to_RH(t, td, formula="Bolton"):
+    if _T_TO_WVP[formula] is _wvp_bolton:
+        return 100 * np.exp( 17.67 * (td / (td + 243.5) - t / (t + 243.5)) )
     es = T_to_WVP(t, formula)
     e = T_to_WVP(td, formula)
     return 100 * e / es
@@ -139,14 +189,14 @@ There are 3 formulas to calculate this.
 (1st) Tetens equation
 (2nd) WMO approximation equation
 (3rd) Bolton equation
+If dtype (e.g. np.float32) is given, inputs are cast to it,
+otherwise the dtype of inputs is kept.
 """
-def T_to_WVP(t, formula="Bolton"):
-    if formula == "Tetens":
-        return 6.1078 * 10 ** (7.5 * t / (t + 237.3))
-    elif formula == "WMO":
-        return np.exp(19.482 - 4303.4 / (t + 243.5))
-    else:
-        return 6.112 * np.exp( 17.67 * t / (t + 243.5) )
+def T_to_WVP(t, formula="Bolton", dtype=None):
+    if dtype is not None:
+        t = np.asarray(t, dtype=dtype)
+
+    return _T_TO_WVP[formula](t)
 
 """
 Calculate air temperature[C] given saturated water vapor pressure[hPa].
@@ -156,12 +206,65 @@ If water vapor pressure[hPa] is input, output dew point temperature[C].
 (3rd) Bolton equation
 """
 def WVP_to_T(es, formula="Bolton"):
-    if formula == "Tetens":
-        return 237.3 * np.log10(6.1078/es) / ( np.log10(es/6.1078) - 7.5 )
-    elif formula == "WMO":
-        return 4303.4 / (19.482 - np.log(es)) - 243.5
-    else:
-        return 243.5 * np.log(es/6.112) / ( 17.67 - np.log(es/6.112) )
+    return _WVP_TO_T[formula](es)
+
+"""
+Implementations of T_to_WVP and WVP_to_T for each formula.
+The formula is selected once by its name, and unknown names fall back to Bolton equation.
+"""
+class _FormulaTable(dict):
+    def __missing__(self, formula):
+        return self["Bolton"]
+
+def _wvp_tetens(t):
+    return 6.1078 * 10 ** (7.5 * t / (t + 237.3))
+
+def _wvp_wmo(t):
+    return np.exp(19.482 - 4303.4 / (t + 243.5))
+
+def _wvp_bolton(t):
+    if njit is not None and type(t) is np.ndarray:
+        return _bolton_ufunc(_wvp_bolton_kernel)(t)
+    return 6.112 * np.exp( 17.67 * t / (t + 243.5) )
+
+def _t_tetens(es):
+    x = np.log10(es/6.1078)
+    return 237.3 * x / (7.5 - x)
+
+def _t_wmo(es):
+    return 4303.4 / (19.482 - np.log(es)) - 243.5
+
+def _t_bolton(es):
+    if njit is not None and type(es) is np.ndarray:
+        return _bolton_ufunc(_t_bolton_kernel)(es)
+    return 243.5 * np.log(es/6.112) / ( 17.67 - np.log(es/6.112) )
+
+_T_TO_WVP = _FormulaTable({"Tetens": _wvp_tetens, "WMO": _wvp_wmo, "Bolton": _wvp_bolton})
+_WVP_TO_T = _FormulaTable({"Tetens": _t_tetens, "WMO": _t_wmo, "Bolton": _t_bolton})
+
+"""
+Scalar kernels of each formula with math module, compiled by numba for the ufuncs and SSI.
+"""
+def _wvp_wmo_kernel(t):
+    return math.exp(19.482 - 4303.4 / (t + 243.5))
+
+def _wvp_bolton_kernel(t):
+    return 6.112 * math.exp( 17.67 * t / (t + 243.5) )
+
+def _t_bolton_kernel(es):
+    x = math.log(es/6.112)
+    return 243.5 * x / (17.67 - x)
+
+"""
+Compiled ufuncs of Bolton equation, used when numba is available.
+They are compiled on first use and cached on disk, so that importing this module stays fast.
+"""
+_BOLTON_UFUNC = {}
+
+def _bolton_ufunc(kernel):
+    if kernel not in _BOLTON_UFUNC:
+        _BOLTON_UFUNC[kernel] = vectorize(["float32(float32)", "float64(float64)"], cache=True)(kernel)
+    return _BOLTON_UFUNC[kernel]
 
 """
 Calculate dew point depression
@@ -174,14 +277,14 @@ def T_Td(t, td):
 Calculate mixing ratio[g/g] given dew point temperature[C] and pressure[hPa].
 """
 def Mixing_Ratio(td, p, formula="Bolton"):
-    e = T_to_WVP(td, formula)
+    e = _T_TO_WVP[formula](td)
     return epsilon * e / (p - e)
 
 """
 Calculate specific humidity[g/g] given dew point temperature[C] and pressure[hPa].
 """
 def Specific_Humidity(td, p, formula="Bolton"):
-    e = T_to_WVP(td, formula)
+    e = _T_TO_WVP[formula](td)
     return epsilon * e / (p - (1 - epsilon) * e)
 
 """
@@ -190,7 +293,7 @@ It's equal to water vapor density.
 """
 def Absolute_Humidity(t, td, formula="Bolton"):
     e = T_to_WVP(td, formula)
-    return 2.16674 * e * 100 / (t + abs_t)
+    return 216.674 * e / (t + abs_t)
 
 """
 Calculate virtual temperature[C] given temperature[C], dew point temperature[C],
@@ -207,8 +310,13 @@ def Virtual_Temperature(t, td, p, formula="Bolton"):
 *-----------------------------*
 
 Calculate potential temperature[K] given air temperature[C] and pressure[hPa].
+If dtype is given, inputs are cast to it.
 """
-def Theta(t, p):
+def Theta(t, p, dtype=None):
+    if dtype is not None:
+        t = np.asarray(t, dtype=dtype)
+        p = np.asarray(p, dtype=dtype)
+
     return (t + abs_t) * ( (1000./p) ** R_div_Cp )
 
 """
@@ -223,16 +331,45 @@ def Tlcl(t, td):
 Calculate equivalent potential temperature[K]
 given air temperature[C], dew point temperature[C], and pressure[hPa].
 Reference : https://www.data.jma.go.jp/add/suishin/jyouhou/pdf/371.pdf
+If dtype is given, inputs are cast to it.
 """
-def Theta_e(t, td, p, formula="Bolton"):
-    e = T_to_WVP(td, formula)
-    m = Mixing_Ratio(td, p, formula)
+def Theta_e(t, td, p, formula="Bolton", dtype=None):
+    if dtype is not None:
+        t = np.asarray(t, dtype=dtype)
+        td = np.asarray(td, dtype=dtype)
+        p = np.asarray(p, dtype=dtype)
+
+    return _THETA_E[formula](t, td, p)
+
+"""
+Implementations of Theta_e specialized for each formula of water vapor pressure.
+_THETA_E_SAT is for saturated air, i.e. Theta_e(t, t, p), where Tlcl is equal to t.
+"""
+def _make_theta_e(wvp):
+    def theta_e(t, td, p):
+        e = wvp(td)
+        m = epsilon * e / (p - e)
 
-    t = t + abs_t
-    td = td + abs_t
-    t_lcl = Tlcl(t, td)
+        t = t + abs_t
+        td = td + abs_t
+        t_lcl = Tlcl(t, td)
 
-    return t * (1000./(p-e))**R_div_Cp_Bolton * (t/t_lcl)**(0.28*m) * np.exp( (3036./t_lcl - 1.78) * m * (1 + 0.448 * m ) )
+        # Accumulate the exponents in log space to evaluate exp only once
+        return t * np.exp( R_div_Cp_Bolton * np.log(1000./(p-e)) + 0.28 * m * np.log(t/t_lcl) + (3036./t_lcl - 1.78) * m * (1 + 0.448 * m ) )
+    return theta_e
+
+def _make_theta_e_sat(wvp):
+    def theta_e_sat(t, p):
+        e = wvp(t)
+        m = epsilon * e / (p - e)
+
+        t = t + abs_t
+
+        return t * np.exp( R_div_Cp_Bolton * np.log(1000./(p-e)) + (3036./t - 1.78) * m * (1 + 0.448 * m ) )
+    return theta_e_sat
+
+_THETA_E = _FormulaTable({f: _make_theta_e(wvp) for f, wvp in _T_TO_WVP.items()})
+_THETA_E_SAT = _FormulaTable({f: _make_theta_e_sat(wvp) for f, wvp in _T_TO_WVP.items()})
 
 """
 Calculate showalter stability index (SSI).
@@ -242,11 +379,6 @@ and air temperature[C] and pressure[hPa] at the destination level
 of the lifting air parcel.
 """
 def SSI(p0, p1, t0, t1, td0, formula="Bolton", **kwargs):
-    tl = np.full_like(t0, -20)
-    diff = np.full_like(t0, 100)
-    th = 0.001
-    step = 120
-
     # Calculate thickness
     if "h0" in kwargs.keys() and "h1" in kwargs.keys():
         thickness = kwargs["h1"] - kwargs["h0"]
@@ -254,6 +386,20 @@ def SSI(p0, p1, t0, t1, td0, formula="Bolton", **kwargs):
         t_ave = (t0 + t1) / 2 + abs_t
         thickness = Rd * t_ave * np.log(p0/p1) / g0
 
+    # Keep float32 if input is float32, otherwise calculate in float64
+    dtype = np.result_type(np.asarray(t0).dtype, np.float32)
+
+    # Use the compiled kernel if numba is available
+    if njit is not None:
+        args = np.broadcast_arrays(p0, p1, t0, t1, td0, thickness)
+        shape = args[0].shape
+        args = [np.ascontiguousarray(x, dtype=np.float64).ravel() for x in args]
+        return _ssi_kernel(*args, _formula_id(formula)).reshape(shape).astype(dtype, copy=False)
+
+    tl = np.full(np.shape(t0), -20.0, dtype=dtype)
+    th = 0.001
+    step = 120
+
     # Calculate temperature of lifted parcel dry-adiabatically from p0 to p1 level
     #  and temperature at LCL
     tl_dry = t0 - thickness * gamma_d
@@ -261,22 +407,97 @@ def SSI(p0, p1, t0, t1, td0, formula="Bolton", **kwargs):
 
     # If t_lift > t_lcl, lifted parcel is not saturated
     tl[ tl_dry > t_lcl ] = tl_dry[ tl_dry > t_lcl ]
-    diff[ tl_dry > t_lcl ] = th / 10
 
-    # If saturated, then calculate temperature of lifted parcel as below
+    # If saturated, then calculate temperature of lifted parcel as below.
+    # Only the points not converged yet are kept in the index array "active".
+    saturated = np.flatnonzero( ~(tl_dry > t_lcl) )
     ept = Theta_e(t0, td0, p0, formula)
+    theta_e_sat = _THETA_E_SAT[formula]
+    ept = np.broadcast_to(ept, tl.shape).ravel()[saturated]
+    p1_s = np.broadcast_to(p1, tl.shape).ravel()[saturated]
+    tl_s = tl.ravel()[saturated]
+    active = np.arange(saturated.size)
     for i in range(20):
         step /= 2
-        diff[ np.abs(diff)>=th ] = ept[ np.abs(diff)>=th ] - Theta_e(tl[ np.abs(diff)>=th ],tl[ np.abs(diff)>=th ],p1[ np.abs(diff)>=th ],formula)
-
-        if (np.abs(diff) < th).all():
+        if active.size == 0:
             break
-        else:
-            tl[ diff >= th ] += step
-            tl[ diff <= - th ] -= step
 
+        diff = ept[active] - theta_e_sat(tl_s[active], p1_s[active])
+
+        tl_s[ active[diff >= th] ] += step
+        tl_s[ active[diff <= - th] ] -= step
+        active = active[ np.abs(diff) >= th ]
+
+    tl.flat[saturated] = tl_s
     return t1 - tl
 
+"""
+Compiled kernel of SSI, used when numba is available.
+Each grid point is lifted independently with the same bisection as above.
+"""
+def _formula_id(formula):
+    if formula == "Tetens":
+        return 1
+    elif formula == "WMO":
+        return 2
+    else:
+        return 0
+
+if njit is not None:
+    # Reuse the same formulas as the functions above
+    _wvp_tetens_jit = njit(_wvp_tetens)
+    _wvp_wmo_jit = njit(_wvp_wmo_kernel)
+    _wvp_bolton_jit = njit(_wvp_bolton_kernel)
+    _tlcl_jit = njit(Tlcl)
+
+    @njit(cache=True)
+    def _t_to_wvp_scalar(t, formula_id):
+        if formula_id == 1:
+            return _wvp_tetens_jit(t)
+        elif formula_id == 2:
+            return _wvp_wmo_jit(t)
+        else:
+            return _wvp_bolton_jit(t)
+
+    @njit(cache=True)
+    def _theta_e_scalar(t, td, p, formula_id):
+        e = _t_to_wvp_scalar(td, formula_id)
+        m = epsilon * e / (p - e)
+
+        t = t + abs_t
+        td = td + abs_t
+        t_lcl = _tlcl_jit(t, td)
+
+        return t * math.exp( R_div_Cp_Bolton * math.log(1000./(p-e)) + 0.28 * m * math.log(t/t_lcl) + (3036./t_lcl - 1.78) * m * (1 + 0.448 * m ) )
+
+    @njit(parallel=True, cache=True)
+    def _ssi_kernel(p0, p1, t0, t1, td0, thickness, formula_id):
+        out = np.empty(t0.size)
+        th = 0.001
+
+        for i in prange(t0.size):
+            tl = t0[i] - thickness[i] * gamma_d
+            t_lcl = _tlcl_jit(t0[i] + abs_t, td0[i] + abs_t) - abs_t
+
+            # If saturated, then calculate temperature of lifted parcel by bisection
+            if not tl > t_lcl:
+                ept = _theta_e_scalar(t0[i], td0[i], p0[i], formula_id)
+                tl = -20.0
+                step = 120.0
+                for j in range(20):
+                    step /= 2
+                    diff = ept - _theta_e_scalar(tl, tl, p1[i], formula_id)
+                    if diff >= th:
+                        tl += step
+                    elif diff <= - th:
+                        tl -= step
+                    else:
+                        break
+
+            out[i] = t1[i] - tl
+
+        return out
+
 """
 Calculate K-Index
 given air temperature[C] and dew point temperature[C] at 850hPa,
@@ -310,33 +531,50 @@ Unit of wind speed
 (1st) m/s  -> knot
 (2nd) knot -> m/s
 """
-def MPS_to_KT(x):
-    return x / 0.51444
+def MPS_to_KT(x, out=None):
+    if out is None:
+        return x / 0.51444
+    return np.divide(x, 0.51444, out=out)
 
-def KT_to_MPS(x):
-    return x * 0.51444
+def KT_to_MPS(x, out=None):
+    if out is None:
+        return x * 0.51444
+    return np.multiply(x, 0.51444, out=out)
 
 """
 Unit of length
 (1st) meter -> feet
 (2nd) feet  -> meter
 """
-def M_to_FT(x):
-    return x / 0.3048
+def M_to_FT(x, out=None):
+    if out is None:
+        return x / 0.3048
+    return np.divide(x, 0.3048, out=out)
 
-def FT_to_M(x):
-    return x * 0.3048
+def FT_to_M(x, out=None):
+    if out is None:
+        return x * 0.3048
+    return np.multiply(x, 0.3048, out=out)
 
 """
 Unit of temperature
 (1st) degrees F -> degrees C
 (2nd) degrees C -> degrees F
+
+If an array is given as "out", the result is written into it
+instead of allocating a new array. "out" may be the input array itself.
 """
-def degF_to_degC(t):
-    return (t - 32.0) / 1.8
+def degF_to_degC(t, out=None):
+    if out is None:
+        return (t - 32.0) / 1.8
+    np.subtract(t, 32.0, out=out)
+    return np.divide(out, 1.8, out=out)
 
-def degC_to_degF(t):
-    return 1.8 * t + 32.0
+def degC_to_degF(t, out=None):
+    if out is None:
+        return 1.8 * t + 32.0
+    np.multiply(t, 1.8, out=out)
+    return np.add(out, 32.0, out=out)
 
 
 """